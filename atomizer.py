@@ -1,6 +1,8 @@
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from itertools import accumulate
 import re
 
 
@@ -20,7 +22,7 @@ class AtomType(str, Enum):
     BLANK = "blank"
 
 
-@dataclass
+@dataclass(slots=True)
 class Atom:
     # Identity & location
     idx: int
@@ -70,8 +72,10 @@ def detect_mode(text: str) -> DocMode:
     for pat in _MD_HINTS:
         if pat.search(text):
             hits += 1
-    # If it shows at least 2 markdown characteristics, call it markdown.
-    return DocMode.MARKDOWN if hits >= 2 else DocMode.PLAIN
+            # If it shows at least 2 markdown characteristics, call it markdown.
+            if hits >= 2:
+                return DocMode.MARKDOWN
+    return DocMode.PLAIN
 
 
 # -----------------------------
@@ -79,12 +83,37 @@ def detect_mode(text: str) -> DocMode:
 # -----------------------------
 
 _RE_HEADING = re.compile(r"^\s{0,3}(#{1,6})\s+(.*?)\s*$")
-_RE_HR = re.compile(r"^\s{0,3}(-{3,}|\*{3,}|_{3,})\s*$")
 _RE_FENCE = re.compile(r"^\s{0,3}(```|~~~)\s*(\S+)?\s*$")  # ```lang
 _RE_LIST = re.compile(r"^\s{0,3}([-*+])\s+\S|^\s{0,3}\d+\.\s+\S")
 _RE_TABLE_SEP = re.compile(r"^\s*\|?(\s*:?-+:?\s*\|)+\s*:?-+:?\s*\|?\s*$")
 _RE_TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$")
-
+_RE_FENCE_CLOSE_BT = re.compile(r"^\s{0,3}```\s*$")
+_RE_FENCE_CLOSE_TD = re.compile(r"^\s{0,3}~~~\s*$")
+_FENCE_CLOSERS = {"```": _RE_FENCE_CLOSE_BT, "~~~": _RE_FENCE_CLOSE_TD}  # opener -> closer
+_RE_LIST_CONT = re.compile(r"^\s{2,}\S")  # indented continuation line
+_RE_BOLD_HEADING = re.compile(r"\*\*(.+?)\*\*")
+_RE_ALLCAPS = re.compile(r"[A-Z0-9][A-Z0-9 \-:,'\".()]+")
+_RE_WS = re.compile(r"\S+")
+
+def _is_hr(line: str) -> bool:
+    """
+    Horizontal rule: up to 3 leading whitespace chars, then 3+ of the same
+    '-', '*' or '_', then only trailing whitespace (e.g. '---', '  ***', '___  ').
+    Hand-rolled instead of a regex so the common "not an HR" case fails on the
+    first non-space char.
+    """
+    i = 0
+    n = len(line)
+    while i < n and i < 3 and line[i].isspace():
+        i += 1
+    if i >= n or line[i] not in "-*_":
+        return False
+    t = line.rstrip()
+    return len(t) - i >= 3 and t.count(line[i], i) == len(t) - i
+
+# Line-level helpers are pure in the line text and lines repeat a lot (bullets,
+# separators, boilerplate), so they are memoized with a bounded cache.
+@lru_cache(maxsize=2048)
 def _is_standalone_bold_heading(line: str) -> Optional[str]:
     """
     Detect lines like:
@@ -93,7 +122,7 @@ def _is_standalone_bold_heading(line: str) -> Optional[str]:
     Returns extracted title if match, else None.
     """
     s = line.strip()
-    m = re.fullmatch(r"\*\*(.+?)\*\*", s)
+    m = _RE_BOLD_HEADING.fullmatch(s)
     if m:
         title = m.group(1).strip()
         # Avoid matching "**bold** in a sentence" (must be whole line)
@@ -101,20 +130,194 @@ def _is_standalone_bold_heading(line: str) -> Optional[str]:
             return title
     return None
 
+@lru_cache(maxsize=2048)
 def _is_allcaps_heading(line: str) -> Optional[str]:
     s = line.strip()
     if not s:
         return None
     # Short-ish, mostly letters/spaces, and many caps
-    if len(s) <= 80 and re.fullmatch(r"[A-Z0-9][A-Z0-9 \-:,'\".()]+", s):
+    if len(s) <= 80 and _RE_ALLCAPS.fullmatch(s):
         # Require at least one letter and majority uppercase
         letters = [c for c in s if c.isalpha()]
         if letters and sum(c.isupper() for c in letters) / len(letters) > 0.8:
             return s
     return None
 
+@lru_cache(maxsize=2048)
 def _count_words(s: str) -> int:
-    return len(re.findall(r"\S+", s))
+    return len(_RE_WS.findall(s))
+
+# Per-line classification bits (one byte per line, see _classify_lines)
+_LC_HR = 1
+_LC_FENCE = 2
+_LC_HEADING = 4      # markdown "# ..." (only honored in markdown mode)
+_LC_BOLD = 8         # standalone **Title**
+_LC_CAPS = 16        # ALLCAPS line
+_LC_LIST = 32
+_LC_TABLE_ROW = 64   # |...| (a table only if the next line is a separator)
+_LC_BLANK = 128
+
+# First non-space chars that can start any of the above (besides blank)
+_CAPS_STARTS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
+_LINE_STARTS = frozenset("#-*_+~`|") | _CAPS_STARTS
+
+def _classify_lines(stripped: List[str]) -> Tuple[bytearray, Dict[int, str]]:
+    """
+    Run every line-level test once per line and pack the results as bit flags,
+    so the atomize walk (notably the paragraph-continuation loop) only reads bits.
+    Also returns the pseudo-heading title for each line flagged BOLD/CAPS, so
+    those lines are never tested twice.
+    """
+    cls = bytearray(len(stripped))
+    pseudo_titles: Dict[int, str] = {}
+    for i, line in enumerate(stripped):
+        ls = line.lstrip()
+        if not ls:
+            cls[i] = _LC_BLANK
+            continue
+        # Every test needs a specific first non-space char, so most prose lines
+        # never reach the regex engine.
+        first = ls[0]
+        if first not in _LINE_STARTS and not first.isdecimal():  # \d in _RE_LIST is any Nd digit
+            continue
+        c = 0
+        if first in "-*_" and _is_hr(line):
+            c |= _LC_HR
+        if first in "`~" and _RE_FENCE.match(line):
+            c |= _LC_FENCE
+        if first == "#" and _RE_HEADING.match(line):
+            c |= _LC_HEADING
+        bold = _is_standalone_bold_heading(line) if first == "*" else None
+        if bold:
+            c |= _LC_BOLD
+        caps = _is_allcaps_heading(line) if first in _CAPS_STARTS else None
+        if caps:
+            c |= _LC_CAPS
+        if bold or caps:
+            pseudo_titles[i] = bold or caps
+        if (first in "-*+" or first.isdecimal()) and _RE_LIST.match(line):
+            c |= _LC_LIST
+        if first == "|" and _RE_TABLE_ROW.match(line):
+            c |= _LC_TABLE_ROW
+        cls[i] = c
+    return cls, pseudo_titles
+
+def _walk_lines(cls: bytearray, stripped: List[str], mode: DocMode) -> List[Tuple[AtomType, int, int]]:
+    """
+    Segmentation walk over the per-line flags from _classify_lines.
+    Returns (atom_type, start_line, end_line) spans in document order, covering every line.
+    Only fence closers, table separators and list continuations still look at the line text.
+    """
+    markdown = mode == DocMode.MARKDOWN
+    # Any of these on the next line ends a paragraph (a table row only if a separator follows)
+    para_stop = _LC_BLANK | _LC_HR | _LC_FENCE | _LC_BOLD | _LC_CAPS | _LC_LIST
+    if markdown:
+        para_stop |= _LC_HEADING
+
+    spans: List[Tuple[AtomType, int, int]] = []
+    n = len(cls)
+    i = 0
+    while i < n:
+        c = cls[i]
+
+        # Blank line
+        if c & _LC_BLANK:
+            spans.append((AtomType.BLANK, i, i))
+            i += 1
+            continue
+
+        # Horizontal rule
+        if c & _LC_HR:
+            spans.append((AtomType.HR, i, i))
+            i += 1
+            continue
+
+        # Fenced code block
+        if c & _LC_FENCE:
+            closer = _FENCE_CLOSERS[_RE_FENCE.match(stripped[i]).group(1)]
+            start = i
+            i += 1
+            while i < n:
+                if closer.match(stripped[i]):
+                    i += 1
+                    break
+                i += 1
+            spans.append((AtomType.CODE_FENCE, start, i - 1))
+            continue
+
+        # Markdown heading (# ...)
+        if markdown and c & _LC_HEADING:
+            spans.append((AtomType.HEADING, i, i))
+            i += 1
+            continue
+
+        # Pseudo heading: standalone **Title** or ALLCAPS line
+        if c & (_LC_BOLD | _LC_CAPS):
+            spans.append((AtomType.PSEUDO_HEADING, i, i))
+            i += 1
+            continue
+
+        # Table block (simple heuristic)
+        # Detect a table header row followed by separator line; or consecutive |...| lines
+        if markdown and c & _LC_TABLE_ROW:
+            # If next line looks like separator, treat as a table block
+            if i + 1 < n and _RE_TABLE_SEP.match(stripped[i + 1]):
+                start = i
+                i += 2
+                while i < n and cls[i] & _LC_TABLE_ROW:
+                    i += 1
+                spans.append((AtomType.TABLE, start, i - 1))
+                continue
+
+        # List block
+        if c & _LC_LIST:
+            start = i
+            i += 1
+            # Continue while lines are list-ish or indented continuation lines
+            while i < n:
+                nc = cls[i]
+                if nc & _LC_BLANK:
+                    # stop before blank line; blank becomes its own atom
+                    break
+                if nc & _LC_LIST:
+                    i += 1
+                    continue
+                # continuation: indented line (common in lists)
+                if _RE_LIST_CONT.match(stripped[i]):
+                    i += 1
+                    continue
+                break
+            spans.append((AtomType.LIST_BLOCK, start, i - 1))
+            continue
+
+        # Paragraph: consume until blank line or a strong boundary starter
+        start = i
+        i += 1
+        while i < n:
+            nc = cls[i]
+            if nc & para_stop:
+                break
+            # Table start checks
+            if markdown and nc & _LC_TABLE_ROW:
+                if i + 1 < n and _RE_TABLE_SEP.match(stripped[i + 1]):
+                    break
+            i += 1
+
+        spans.append((AtomType.PARAGRAPH, start, i - 1))
+
+    return spans
+
+# (can_cut_before, boundary_strength) per atom type
+_CUT_INFO = {
+    AtomType.BLANK: (False, 0.0),
+    AtomType.HR: (True, 0.9),
+    AtomType.CODE_FENCE: (True, 0.6),
+    AtomType.HEADING: (True, 1.0),
+    AtomType.PSEUDO_HEADING: (True, 0.95),
+    AtomType.TABLE: (True, 0.6),
+    AtomType.LIST_BLOCK: (True, 0.5),
+    AtomType.PARAGRAPH: (False, 0.1),
+}
 
 def atomize(text: str, mode: Optional[DocMode] = None) -> tuple[list[Atom], dict[int, int]]:
     """
@@ -128,13 +331,16 @@ def atomize(text: str, mode: Optional[DocMode] = None) -> tuple[list[Atom], dict
 
     # Work line-by-line but keep byte offsets
     lines = text.splitlines(keepends=True)
+    # Same lines without their trailing "\n"; what all the line tests look at
+    stripped = [ln[:-1] if ln.endswith("\n") else ln for ln in lines]
+
+    # Precompute byte offsets per line (start byte of each line), plus a trailing len(text).
+    # Python str offsets are fine in this context, so these are really character offsets.
+    line_start_byte: List[int] = list(accumulate((len(ln) for ln in lines), initial=0))
 
-    # Precompute byte offsets per line (start byte of each line)
-    line_start_byte: List[int] = []
-    b = 0
-    for ln in lines:
-        line_start_byte.append(b)
-        b += len(ln.encode("utf-8")) if False else len(ln)  # assume Python str is fine for offsets in this context
+    # Word-count prefix sums per line; atom weights become a two-element lookup.
+    # A word never spans a line break, so this matches counting over the joined chunk.
+    line_words_pref: List[int] = list(accumulate((_count_words(ln) for ln in stripped), initial=0))
 
     atoms: List[Atom] = []
     idx = 0
@@ -145,33 +351,30 @@ def atomize(text: str, mode: Optional[DocMode] = None) -> tuple[list[Atom], dict
 
     section_registry: dict[int, int] = {}  # node_id -> atom_idx
 
-    def current_section_path_titles() -> Tuple[str, ...]:
-        return tuple(title for _, _, title in heading_stack)
-
-    def current_section_path_ids() -> Tuple[int, ...]:
-        return tuple(node_id for _, node_id, _ in heading_stack)
-
-    def current_section_node_id() -> Optional[int]:
-        return heading_stack[-1][1] if heading_stack else None
+    # Current section path derived from heading_stack; shared by every atom until the next heading
+    cur_path_titles: Tuple[str, ...] = ()
+    cur_path_ids: Tuple[int, ...] = ()
+    cur_node_id: Optional[int] = None
 
     def push_heading(depth: int, title: str) -> None:
-        nonlocal next_node_id
+        nonlocal next_node_id, cur_path_titles, cur_path_ids, cur_node_id
         while heading_stack and heading_stack[-1][0] >= depth:
             heading_stack.pop()
         heading_stack.append((depth, next_node_id, title))
         next_node_id += 1
+        cur_path_titles = tuple(t for _, _, t in heading_stack)
+        cur_path_ids = tuple(node_id for _, node_id, _ in heading_stack)
+        cur_node_id = heading_stack[-1][1]
 
     def emit(atom_type: AtomType, start_line: int, end_line: int,
              depth: int = 0, can_cut_before: bool = False, boundary_strength: float = 0.0) -> None:
         nonlocal idx
-        start_byte = line_start_byte[start_line] if start_line < len(line_start_byte) else len(text)
+        start_byte = line_start_byte[start_line]
         # end_byte = start of line after end_line, or end of text
-        if end_line + 1 < len(line_start_byte):
-            end_byte = line_start_byte[end_line + 1]
-        else:
-            end_byte = len(text)
+        end_byte = line_start_byte[end_line + 1]
 
-        chunk = "".join(lines[start_line:end_line + 1])
+        # Offsets are cumulative line lengths, so this is exactly the joined lines
+        chunk = text[start_byte:end_byte]
         atoms.append(Atom(
             idx=idx,
             atom_type=atom_type,
@@ -181,132 +384,43 @@ def atomize(text: str, mode: Optional[DocMode] = None) -> tuple[list[Atom], dict
             end_line=end_line,
             text=chunk,
             weight_chars=len(chunk),
-            weight_words=_count_words(chunk),
+            weight_words=line_words_pref[end_line + 1] - line_words_pref[start_line],
             depth=depth,
-            section_path=current_section_path_titles(),
-            section_path_ids=current_section_path_ids(),
-            section_node_id=current_section_node_id(),
+            section_path=cur_path_titles,
+            section_path_ids=cur_path_ids,
+            section_node_id=cur_node_id,
             can_cut_before=can_cut_before,
             boundary_strength=boundary_strength,
         ))
         idx += 1
 
-    i = 0
-    while i < len(lines):
-        raw = lines[i]
-        line = raw.rstrip("\n")
+    cls, pseudo_titles = _classify_lines(stripped)
+    spans = _walk_lines(cls, stripped, mode)
 
-        # Blank line
-        if line.strip() == "":
-            emit(AtomType.BLANK, i, i, can_cut_before=False, boundary_strength=0.0)
-            i += 1
-            continue
-
-        # Horizontal rule
-        if _RE_HR.match(line):
-            emit(AtomType.HR, i, i, can_cut_before=True, boundary_strength=0.9)
-            i += 1
-            continue
+    for atom_type, start, end in spans:
+        can_cut_before, boundary_strength = _CUT_INFO[atom_type]
 
-        # Fenced code block
-        m_f = _RE_FENCE.match(line)
-        if m_f:
-            fence = m_f.group(1)
-            start = i
-            i += 1
-            while i < len(lines):
-                if re.match(rf"^\s{{0,3}}{re.escape(fence)}\s*$", lines[i].rstrip("\n")):
-                    i += 1
-                    break
-                i += 1
-            emit(AtomType.CODE_FENCE, start, i - 1, can_cut_before=True, boundary_strength=0.6)
+        if atom_type == AtomType.HEADING:
+            m_h = _RE_HEADING.match(stripped[start])
+            depth = len(m_h.group(1))
+            title = m_h.group(2).strip()
+            push_heading(depth, title)
+            emit(atom_type, start, end, depth=depth, can_cut_before=can_cut_before, boundary_strength=boundary_strength)
+            section_registry[cur_node_id] = idx - 1
             continue
 
-        # Markdown heading (# ...)
-        if mode == DocMode.MARKDOWN:
-            m_h = _RE_HEADING.match(line)
-            if m_h:
-                depth = len(m_h.group(1))
-                title = m_h.group(2).strip()
-                push_heading(depth, title)
-                emit(AtomType.HEADING, i, i, depth=depth, can_cut_before=True, boundary_strength=1.0)
-                section_registry[current_section_node_id()] = idx - 1
-                i += 1
-                continue
-
-        # Pseudo heading: standalone **Title** or ALLCAPS line
-        title = _is_standalone_bold_heading(line) or _is_allcaps_heading(line)
-        if title:
+        if atom_type == AtomType.PSEUDO_HEADING:
+            title = pseudo_titles[start]
             parent_depth = heading_stack[-1][0] if heading_stack else 0
             pseudo_depth = min(parent_depth + 1, 6) if parent_depth > 0 else 1
 
             push_heading(pseudo_depth, title)
-            emit(AtomType.PSEUDO_HEADING, i, i, depth=pseudo_depth, can_cut_before=True, boundary_strength=0.95)
-
-            section_registry[current_section_node_id()] = idx - 1
+            emit(atom_type, start, end, depth=pseudo_depth, can_cut_before=can_cut_before, boundary_strength=boundary_strength)
 
-            i += 1
+            section_registry[cur_node_id] = idx - 1
             continue
 
-        # Table block (simple heuristic)
-        # Detect a table header row followed by separator line; or consecutive |...| lines
-        if mode == DocMode.MARKDOWN and _RE_TABLE_ROW.match(line):
-            # If next line looks like separator, treat as a table block
-            if i + 1 < len(lines) and _RE_TABLE_SEP.match(lines[i + 1].rstrip("\n")):
-                start = i
-                i += 2
-                while i < len(lines) and _RE_TABLE_ROW.match(lines[i].rstrip("\n")):
-                    i += 1
-                emit(AtomType.TABLE, start, i - 1, can_cut_before=True, boundary_strength=0.6)
-                continue
-
-        # List block
-        if _RE_LIST.match(line):
-            start = i
-            i += 1
-            # Continue while lines are list-ish or indented continuation lines
-            while i < len(lines):
-                nxt = lines[i].rstrip("\n")
-                if nxt.strip() == "":
-                    # stop before blank line; blank becomes its own atom
-                    break
-                if _RE_LIST.match(nxt):
-                    i += 1
-                    continue
-                # continuation: indented line (common in lists)
-                if re.match(r"^\s{2,}\S", nxt):
-                    i += 1
-                    continue
-                break
-            emit(AtomType.LIST_BLOCK, start, i - 1, can_cut_before=True, boundary_strength=0.5)
-            continue
-
-        # Paragraph: consume until blank line or a strong boundary starter
-        start = i
-        i += 1
-        while i < len(lines):
-            nxt_raw = lines[i]
-            nxt = nxt_raw.rstrip("\n")
-            if nxt.strip() == "":
-                break
-            if _RE_HR.match(nxt):
-                break
-            if _RE_FENCE.match(nxt):
-                break
-            if mode == DocMode.MARKDOWN and _RE_HEADING.match(nxt):
-                break
-            if _is_standalone_bold_heading(nxt) or _is_allcaps_heading(nxt):
-                break
-            if _RE_LIST.match(nxt):
-                break
-            # Table start checks
-            if mode == DocMode.MARKDOWN and _RE_TABLE_ROW.match(nxt):
-                if i + 1 < len(lines) and _RE_TABLE_SEP.match(lines[i + 1].rstrip("\n")):
-                    break
-            i += 1
-
-        emit(AtomType.PARAGRAPH, start, i - 1, can_cut_before=False, boundary_strength=0.1)
-        continue
+        emit(atom_type, start, end, can_cut_before=can_cut_before, boundary_strength=boundary_strength)
 
     # Post-pass: mark "can_cut_before" for paragraphs that follow a blank or are large (fallback boundaries)
     # (Optional) You can keep this off initially.
@@ -315,9 +429,21 @@ def atomize(text: str, mode: Optional[DocMode] = None) -> tuple[list[Atom], dict
     #         atoms[j].can_cut_before = True
     #         atoms[j].boundary_strength = max(atoms[j].boundary_strength, 0.2)
 
-    # -----------------------------
-    # Sanity checks (debug / dev)
-    # -----------------------------
+    if _VALIDATE_ATOMIZE:
+        validate_atoms(atoms, section_registry)
+
+    return atoms, section_registry
+
+
+# -----------------------------
+# Sanity checks (debug / dev)
+# -----------------------------
+
+# Set True to run validate_atoms() at the end of every atomize() call.
+_VALIDATE_ATOMIZE = False
+
+def validate_atoms(atoms: List[Atom], section_registry: dict[int, int]) -> None:
+    """Assert that every section_registry entry points at its defining heading atom."""
     for node_id, atom_idx in section_registry.items():
         assert 0 <= atom_idx < len(atoms), (
             f"section_registry points to invalid atom_idx {atom_idx}"
@@ -331,8 +457,6 @@ def atomize(text: str, mode: Optional[DocMode] = None) -> tuple[list[Atom], dict
             f"Registry points to non-heading atom type {a.atom_type}"
         )
 
-    return atoms, section_registry
-
 
 # -----------------------------
 # Tiny debug helper
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
+from array import array
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from itertools import accumulate
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from atomizer import Atom, AtomType
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Segment:
     seg_idx: int
     start_atom: int
@@ -16,7 +18,7 @@ class Segment:
     start_path_titles: Tuple[str, ...]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PartitionResult:
     cuts: List[int]                 # length N-1; each is atom index where a new segment starts
     segments: List[Segment]         # length N
@@ -24,12 +26,7 @@ class PartitionResult:
 
 
 def _prefix_words(atoms: List[Atom]) -> List[int]:
-    pref = [0]
-    s = 0
-    for a in atoms:
-        s += a.weight_words
-        pref.append(s)
-    return pref
+    return list(accumulate((a.weight_words for a in atoms), initial=0))
 
 
 def _is_heading_atom(a: Atom) -> bool:
@@ -53,6 +50,10 @@ def _cut_tier(a: Atom) -> int:
     return 3
 
 
+# Block atom types that become cut candidates under allow_list_table_code
+_BLOCK_CUT_TYPES = frozenset({AtomType.LIST_BLOCK, AtomType.TABLE, AtomType.CODE_FENCE})
+
+
 def build_cut_candidates(
     atoms: List[Atom],
     *,
@@ -85,7 +86,7 @@ def build_cut_candidates(
         if allow_hr and a.atom_type == AtomType.HR:
             cands.append(i)
             continue
-        if allow_list_table_code and a.atom_type in {AtomType.LIST_BLOCK, AtomType.TABLE, AtomType.CODE_FENCE}:
+        if allow_list_table_code and a.atom_type in _BLOCK_CUT_TYPES:
             cands.append(i)
             continue
         if allow_paragraph_fallback and a.atom_type == AtomType.PARAGRAPH:
@@ -104,18 +105,20 @@ def partition_into_n(
     *,
     non_heading_penalty: float = 1.0,
     tier_penalties: Optional[Dict[int, float]] = None,
+    word_prefix: Optional[Sequence[int]] = None,
 ) -> PartitionResult:
     """
     Lexicographic DP:
       minimize (#non_heading_cuts, max_segment_words, penalty_sum)
 
     - candidates: possible cut positions i (start indices) in [1, M-1]
+    - word_prefix: optional precomputed word prefix sums (length M+1), e.g. shared across retries
     - returns cuts of length N-1 (start indices of segments 2..N)
     """
     assert N >= 1
     M = len(atoms)
+    pref = _prefix_words(atoms) if word_prefix is None else word_prefix
     if N == 1:
-        pref = _prefix_words(atoms)
         seg = Segment(
             seg_idx=0,
             start_atom=0,
@@ -135,20 +138,18 @@ def partition_into_n(
     if tier_penalties is None:
         tier_penalties = {0: 0.0, 1: 0.2, 2: 0.5, 3: 1.0}
 
-    def cut_cost(i_boundary: int) -> Tuple[int, float]:
-        """
-        Cost of choosing a cut that starts a segment at atom index i_boundary.
-        - For i_boundary == M (end), no cut.
-        """
-        if i_boundary == M or i_boundary == 0:
-            return (0, 0.0)
-        a = atoms[i_boundary]
-        tier = _cut_tier(a)
-        is_non_heading = 0 if _is_heading_atom(a) else 1
-        penalty = tier_penalties.get(tier, 1.0)
-        return (is_non_heading, penalty)
-
-    pref = _prefix_words(atoms)
+    # Cost of the cut that starts a segment at boundary pos[j] depends only on j,
+    # so compute it once per boundary. pos 0 (start) and M (end) are not cuts.
+    cut_nh: List[int] = [0] * L             # 1 if the cut is not at a markdown heading
+    cut_nh_pen: List[float] = [0.0] * L     # non_heading_penalty * cut_nh
+    cut_pen: List[float] = [0.0] * L        # tier penalty
+    for j, p in enumerate(pos):
+        if p == M or p == 0:
+            continue
+        a = atoms[p]
+        cut_nh[j] = 0 if _is_heading_atom(a) else 1
+        cut_nh_pen[j] = non_heading_penalty * float(cut_nh[j])
+        cut_pen[j] = tier_penalties.get(_cut_tier(a), 1.0)
 
     def seg_words(j: int, i: int) -> int:
         # segment covers atoms[pos[j] : pos[i]]
@@ -156,44 +157,50 @@ def partition_into_n(
 
     # DP over k segments using boundaries in pos.
     # dp[k][i] = best objective for partitioning [0..pos[i]) into k segments, where last boundary is pos[i]
-    # parent pointers for reconstruction.
+    # The objective triple is stored column-wise (one typed array per component and row),
+    # plus parent pointers for reconstruction.
     INF = (10**9, 10**9, 1e30)
-    dp: List[List[Tuple[int, int, float]]] = [[INF] * L for _ in range(N + 1)]
-    parent: List[List[int]] = [[-1] * L for _ in range(N + 1)]
+    dp_nh: List[array] = [array("q", [INF[0]]) * L for _ in range(N + 1)]
+    dp_mw: List[array] = [array("q", [INF[1]]) * L for _ in range(N + 1)]
+    dp_pen: List[array] = [array("d", [INF[2]]) * L for _ in range(N + 1)]
+    parent: List[array] = [array("q", [-1]) * L for _ in range(N + 1)]
 
     # Base: 1 segment ending at i
     for i in range(1, L):
-        w = seg_words(0, i)
-        dp[1][i] = (0, w, 0.0)  # no cuts
+        dp_nh[1][i] = 0  # no cuts
+        dp_mw[1][i] = seg_words(0, i)
+        dp_pen[1][i] = 0.0
         parent[1][i] = 0
 
+    # Prefix words at each boundary: segment j -> i weighs words_at[i] - words_at[j]
+    words_at = [pref[p] for p in pos]
+
     # Transitions
     for k in range(2, N + 1):
-        for i in range(1, L):
-            best = INF
-            best_j = -1
-            # Try previous boundary j < i
-            for j in range(0, i):
-                prev = dp[k - 1][j]
-                if prev == INF:
-                    continue
-                w = seg_words(j, i)
-                non_head, pen = cut_cost(pos[j])  # cut that starts segment k at pos[j], except k=1 handled above
-                # IMPORTANT: the cut that *creates* segment k is at boundary pos[j] (start of current segment)
-                # For k segments, we have cuts at starts of segments 2..k => boundaries pos[j] when transitioning.
-                cand = (
-                    prev[0] + non_head,
-                    max(prev[1], w),
-                    prev[2] + non_heading_penalty * float(non_head) + pen,
+        prev_nh, prev_mw, prev_pen = dp_nh[k - 1], dp_mw[k - 1], dp_pen[k - 1]
+        # dp[k-1][j] is feasible exactly when j >= k-1 (every segment needs its own boundary),
+        # so only those j are tried and dp[k][i] stays INF for i < k.
+        for i in range(k, L):
+            w_i = words_at[i]
+            # Lexicographic argmin over previous boundaries j < i; ties go to the smallest j.
+            # IMPORTANT: the cut that *creates* segment k is at boundary pos[j] (start of current segment)
+            # For k segments, we have cuts at starts of segments 2..k => boundaries pos[j] when transitioning.
+            best, best_j = min(
+                (
+                    (
+                        prev_nh[j] + cut_nh[j],
+                        max(prev_mw[j], w_i - words_at[j]),
+                        prev_pen[j] + cut_nh_pen[j] + cut_pen[j],
+                    ),
+                    j,
                 )
-                if cand < best:
-                    best = cand
-                    best_j = j
-            dp[k][i] = best
+                for j in range(k - 1, i)
+            )
+            dp_nh[k][i], dp_mw[k][i], dp_pen[k][i] = best
             parent[k][i] = best_j
 
     # We require exactly N segments ending at M -> position index L-1
-    obj = dp[N][L - 1]
+    obj = (dp_nh[N][L - 1], dp_mw[N][L - 1], dp_pen[N][L - 1])
     if obj == INF:
         raise ValueError("No feasible partition: not enough candidate boundaries or N too large.")
 
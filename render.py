@@ -1,7 +1,13 @@
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Set, Tuple
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Set, TextIO, Tuple
 from atomizer import Atom, AtomType
 from bisect import bisect_right
+import io
+from itertools import accumulate, groupby
+from operator import itemgetter
 
 
 def _segment_of_atom_idx(def_idx: int, cuts: List[int]) -> int:
@@ -12,6 +18,11 @@ def _segment_of_atom_idx(def_idx: int, cuts: List[int]) -> int:
     return bisect_right(cuts, def_idx)
 
 
+def _truncate(s: str, n: int) -> str:
+    """s cut to at most n characters, the last one being a single-codepoint ellipsis."""
+    return (s[: n - 1] + "…") if len(s) > n else s
+
+
 def _escape_mermaid_label(s: str) -> str:
     """
     Mermaid node labels are usually placed inside double quotes:
@@ -23,6 +34,107 @@ def _escape_mermaid_label(s: str) -> str:
     return s.strip()
 
 
+# -----------------------------
+# Hot per-atom passes (kept as plain module-level loops over atoms)
+# -----------------------------
+
+def _section_spans(atoms: List[Atom], tracked: FrozenSet[int]) -> Dict[int, Tuple[int, int]]:
+    """
+    (first, last) atom index of every tracked section node, in one forward pass.
+    Atoms are in document order, so a section's span is its first and last member.
+    """
+    span_lo: Dict[int, int] = {}
+    span_hi: Dict[int, int] = {}
+    first_seen = span_lo.setdefault
+    for k, a in enumerate(atoms):
+        for nid in a.section_path_ids:
+            if nid in tracked:
+                first_seen(nid, k)
+                span_hi[nid] = k
+    return {nid: (lo, span_hi[nid]) for nid, lo in span_lo.items()}
+
+
+def _leaves_by_section(
+    atoms: List[Atom],
+    included_nodes: Set[int],
+    leaf_atom_types: FrozenSet[AtomType],
+) -> Dict[int, List[int]]:
+    """
+    Group leaf atoms (of leaf_atom_types) under their nearest included section node,
+    i.e. the atom's own section if included, else its closest included ancestor.
+    """
+    leaves_by_section: Dict[int, List[int]] = defaultdict(list)
+    if not leaf_atom_types:
+        return leaves_by_section
+
+    # Only leaf-type atoms resolve an attach section; BLANK is never in leaf_atom_types
+    # (the caller removes it)
+    for a in atoms:
+        if a.atom_type not in leaf_atom_types:
+            continue
+        sid = a.section_node_id
+        if sid is None or sid not in included_nodes:
+            sid = next((s for s in reversed(a.section_path_ids) if s in included_nodes), None)
+            if sid is None:
+                continue
+        leaves_by_section[sid].append(a.idx)
+    return leaves_by_section
+
+
+# Atom types that define a section node
+_HEADING_TYPES: FrozenSet[AtomType] = frozenset({AtomType.HEADING, AtomType.PSEUDO_HEADING})
+_MD_HEADING_TYPES: FrozenSet[AtomType] = frozenset({AtomType.HEADING})  # include_pseudo_headings=False
+
+
+# Leaf type names accepted in MermaidOptions.leaf_types / empty_leaf_types
+_NAME_TO_TYPE: Mapping[str, AtomType] = MappingProxyType({
+    "paragraph": AtomType.PARAGRAPH,
+    "list": AtomType.LIST_BLOCK,
+    "code": AtomType.CODE_FENCE,
+    "code_fence": AtomType.CODE_FENCE,
+    "table": AtomType.TABLE,
+})
+
+
+@lru_cache(maxsize=64)
+def _atom_types_from_names(names: Tuple[str, ...]) -> FrozenSet[AtomType]:
+    """Known leaf type names -> AtomTypes (unknown names are ignored); memoized per tuple."""
+    return frozenset(
+        at for at in (_NAME_TO_TYPE.get(tname.strip().lower()) for tname in names)
+        if at is not None
+    )
+
+
+# Single-letter labels for non-empty leaf boxes
+_LEAF_LABELS: Dict[AtomType, str] = {
+    AtomType.CODE_FENCE: "C",
+    AtomType.TABLE: "T",
+    AtomType.PARAGRAPH: "P",
+    AtomType.LIST_BLOCK: "L",
+}
+
+# %-templates for the per-node / per-leaf / per-edge lines (one C-level format per emitted line)
+_NODE_FMT = '    %s["%s"]\n'
+_CLASS_FMT = "class %s %s;\n"
+_LEAF_FMT = '    A%d["%s"]\n    %s --> A%d\n    class A%d %s;\n'
+_LEAF_SEG_FMT_FULL = _LEAF_FMT + "    class A%d %s;\n"  # leaf plus its segment class (cuts given)
+_EDGE_FMT = "    %s --> %s\n"
+_MORE_FMT = '    A%d_MORE["… (+%d)"]\n    %s --> A%d_MORE\n    class A%d_MORE leafLabeled;\n'
+_MORE_SEG_FMT = "    class A%d_MORE %s;\n"
+
+# (fill, stroke, text) per segment class, cycled when there are more segments
+_SEG_PALETTE: Tuple[Tuple[str, str, str], ...] = (
+    ("#E3F2FD", "#1E88E5", "#0D47A1"),  # blue
+    ("#E8F5E9", "#43A047", "#1B5E20"),  # green
+    ("#FFF3E0", "#FB8C00", "#E65100"),  # orange
+    ("#F3E5F5", "#8E24AA", "#4A148C"),  # purple
+    ("#FCE4EC", "#D81B60", "#880E4F"),  # pink
+    ("#E0F7FA", "#00ACC1", "#006064"),  # cyan
+    ("#F1F8E9", "#7CB342", "#33691E"),  # lime
+    ("#EFEBE9", "#6D4C41", "#3E2723"),  # brown
+)
+
+
 @dataclass(frozen=True)
 class MermaidOptions:
     direction: str = "TD"  # TD, LR, RL, BT
@@ -52,42 +164,61 @@ def render_mermaid(
 
     Returns Mermaid markdown string (starts with '```mermaid').
     """
+    buf = io.StringIO()
+    render_mermaid_to(buf, atoms, section_registry, opts=opts, cuts=cuts)
+    return buf.getvalue()
+
+
+def render_mermaid_to(
+    stream: TextIO,
+    atoms: List[Atom],
+    section_registry: Dict[int, int],
+    *,
+    opts: Optional[MermaidOptions] = None,
+    cuts: Optional[List[int]] = None,
+) -> None:
+    """
+    Same as render_mermaid, but writes the diagram to a text stream piece by piece
+    instead of building the whole string (large diagrams go straight to the file).
+    """
     if opts is None:
         opts = MermaidOptions()
+    # Options read once; the loops and closures below use these locals
+    include_stats = opts.include_section_stats
+    include_leaves = opts.include_leaves
+    include_pseudo = opts.include_pseudo_headings
+    dedupe_titles = opts.dedupe_titles
+    max_label_len = opts.max_label_len
+    max_leaves = opts.max_leaves_per_section
 
     # --- helpers ---
     def label_for_node(node_id: int, atom_idx: int) -> str:
         a = atoms[atom_idx]
         title = a.section_path[-1] if a.section_path else f"section_{node_id}"
-        if opts.dedupe_titles:
+        if dedupe_titles:
             title = f"{title} [{node_id}]"
-        if opts.include_section_stats:
+        if include_stats:
             span = _section_span_atom_indices(node_id)
             if span is not None:
                 lo, hi = span
-                w = sum(atoms[k].weight_words for k in range(lo, hi + 1))
+                w = word_pref[hi + 1] - word_pref[lo]
                 title = f"{title} (atoms {lo}-{hi}, words={w})"
-        if len(title) > opts.max_label_len:
-            title = title[: opts.max_label_len - 1] + "…"
-        return _escape_mermaid_label(title)
+        return _escape_mermaid_label(_truncate(title, max_label_len))
 
     # Determine which nodes to include (filter pseudo headings if desired)
-    included_nodes: Set[int] = set()
-    node_atom: Dict[int, int] = {}
-
-    for node_id, atom_idx in section_registry.items():
-        if atom_idx < 0 or atom_idx >= len(atoms):
-            continue
-        a = atoms[atom_idx]
-        if a.atom_type == AtomType.PSEUDO_HEADING and not opts.include_pseudo_headings:
-            continue
-        if a.atom_type not in {AtomType.HEADING, AtomType.PSEUDO_HEADING}:
-            continue
-        included_nodes.add(node_id)
-        node_atom[node_id] = atom_idx
-
-    # Build parent -> child edges using section_path_ids from the defining atom
-    edges: Set[Tuple[int, int]] = set()
+    # One pass fills node_atom; included_nodes is derived from its keys
+    node_types = _HEADING_TYPES if include_pseudo else _MD_HEADING_TYPES
+    n_atoms = len(atoms)
+    node_atom: Dict[int, int] = {
+        node_id: atom_idx
+        for node_id, atom_idx in section_registry.items()
+        if 0 <= atom_idx < n_atoms and atoms[atom_idx].atom_type in node_types
+    }
+    included_nodes: Set[int] = set(node_atom)
+
+    # Build parent -> child edges using section_path_ids from the defining atom.
+    # Each node gets at most one incoming edge, so an adjacency list needs no dedupe.
+    children: Dict[int, List[int]] = defaultdict(list)
     parent_map: Dict[int, Optional[int]] = {}
 
     for node_id, atom_idx in node_atom.items():
@@ -95,7 +226,7 @@ def render_mermaid(
         parent_id = pid[-2] if len(pid) >= 2 else None
         parent_map[node_id] = parent_id
         if parent_id is not None and parent_id in included_nodes:
-            edges.add((parent_id, node_id))
+            children[parent_id].append(node_id)
 
     # Optionally include missing parents to keep the tree connected (best effort)
     if opts.include_root:
@@ -106,190 +237,113 @@ def render_mermaid(
             if node_id == ROOT_ID:
                 continue
             if parent_id is None or parent_id not in included_nodes:
-                edges.add((ROOT_ID, node_id))
+                children[ROOT_ID].append(node_id)
 
     # Precompute section spans if requested
     section_span_cache: Dict[int, Tuple[int, int]] = {}
-    if opts.include_section_stats:
-        membership: Dict[int, List[int]] = {nid: [] for nid in included_nodes if nid != 0}
-        for k, a in enumerate(atoms):
-            for nid in a.section_path_ids:
-                if nid in membership:
-                    membership[nid].append(k)
-        for nid, ks in membership.items():
-            if ks:
-                section_span_cache[nid] = (min(ks), max(ks))
+    word_pref: List[int] = []  # word_pref[k] = words in atoms[:k]
+    if include_stats:
+        word_pref = list(accumulate((a.weight_words for a in atoms), initial=0))
+        section_span_cache = _section_spans(atoms, frozenset(included_nodes - {0}))
 
     def _section_span_atom_indices(node_id: int) -> Optional[Tuple[int, int]]:
         return section_span_cache.get(node_id)
 
-    # Helper: attach leaves to nearest included section node
-    def _attach_section_id(a: Atom) -> Optional[int]:
-        if a.section_node_id is not None and a.section_node_id in included_nodes:
-            return a.section_node_id
-        for sid in reversed(a.section_path_ids):
-            if sid in included_nodes:
-                return sid
-        return None
-
     # If cuts exist, compute section-node -> segment map (for coloring section nodes)
     node_to_seg: Dict[int, int] = {}
     if cuts is not None:
-        for nid, atom_idx in node_atom.items():
-            if nid == 0 or atom_idx < 0:
-                continue
-            node_to_seg[nid] = _segment_of_atom_idx(atom_idx, cuts)
+        node_to_seg = {
+            nid: _segment_of_atom_idx(atom_idx, cuts)
+            for nid, atom_idx in node_atom.items()
+            if nid != 0 and atom_idx >= 0
+        }
+
+    # Mermaid ids, formatted once per node / segment
+    snames: Dict[int, str] = {nid: f"S{nid}" for nid in included_nodes}
+    snames[0] = "ROOT"
+    seg_class_names: List[str] = [f"sec{s+1}" for s in range(len(cuts) + 1)] if cuts is not None else []
 
     # Render Mermaid
-    lines: List[str] = []
-    lines.append("```mermaid")
+    w = stream.write  # bound once; every write carries its own "\n"
+    w("```mermaid\n")
 
     if cuts is not None:
-        lines.append('%%{init: {"flowchart": {"nodeSpacing": 12, "rankSpacing": 28}} }%%')
+        w('%%{init: {"flowchart": {"nodeSpacing": 12, "rankSpacing": 28}} }%%\n')
 
-    lines.append(f"flowchart {opts.direction}")
+    w(f"flowchart {opts.direction}\n")
 
     # --- Define class styles FIRST (so leaves can reference sec* classes) ---
     if cuts is not None:
-        n_segs = len(cuts) + 1
-        palette = [
-            ("#E3F2FD", "#1E88E5", "#0D47A1"),  # blue
-            ("#E8F5E9", "#43A047", "#1B5E20"),  # green
-            ("#FFF3E0", "#FB8C00", "#E65100"),  # orange
-            ("#F3E5F5", "#8E24AA", "#4A148C"),  # purple
-            ("#FCE4EC", "#D81B60", "#880E4F"),  # pink
-            ("#E0F7FA", "#00ACC1", "#006064"),  # cyan
-            ("#F1F8E9", "#7CB342", "#33691E"),  # lime
-            ("#EFEBE9", "#6D4C41", "#3E2723"),  # brown
-        ]
-        for s in range(n_segs):
-            fill, stroke, text = palette[s % len(palette)]
-            lines.append(
-                f"classDef sec{s+1} fill:{fill},stroke:{stroke},stroke-width:1px,color:{text};"
-            )
+        for s, name in enumerate(seg_class_names):
+            fill, stroke, text = _SEG_PALETTE[s % len(_SEG_PALETTE)]
+            w(f"classDef {name} fill:{fill},stroke:{stroke},stroke-width:1px,color:{text};\n")
 
     # Leaf styles: keep them subtle
-    lines.append("classDef leafEmpty stroke-width:1px;")
-    lines.append("classDef leafLabeled stroke-width:1px;")
+    w("classDef leafEmpty stroke-width:1px;\n")
+    w("classDef leafLabeled stroke-width:1px;\n")
 
     # Emit section nodes (always flat)
-    for nid in sorted(included_nodes):
+    node_order = sorted(included_nodes)
+
+    for nid in node_order:
         if nid == 0:
-            lines.append('    ROOT["ROOT"]')
+            w('    ROOT["ROOT"]\n')
             continue
         atom_idx = node_atom.get(nid)
         if atom_idx is None:
             continue
         lbl = label_for_node(nid, atom_idx)
-        lines.append(f'    S{nid}["{lbl}"]')
+        w(_NODE_FMT % (snames[nid], lbl))
 
     # Color section nodes
     if cuts is not None:
-        seg_to_nodes: Dict[int, List[int]] = {}
-        for nid in sorted(included_nodes):
-            if nid == 0:
-                continue
-            seg = node_to_seg.get(nid, 0)
-            seg_to_nodes.setdefault(seg, []).append(nid)
-        for seg, nids in sorted(seg_to_nodes.items()):
-            joined = ",".join(f"S{nid}" for nid in nids)
-            lines.append(f"class {joined} sec{seg+1};")
+        # One sort of (seg, nid) pairs; groupby then yields each segment's nodes in id order
+        seg_of = node_to_seg.get
+        pairs = sorted((seg_of(nid, 0), nid) for nid in included_nodes if nid != 0)
+        for seg, grp in groupby(pairs, key=itemgetter(0)):
+            joined = ",".join([snames[nid] for _, nid in grp])
+            w(_CLASS_FMT % (joined, seg_class_names[seg]))
 
     # Optional: emit leaf atoms (paragraph/list/code/table) under nearest included section node
-    if opts.include_leaves:
-        name_to_type = {
-            "paragraph": AtomType.PARAGRAPH,
-            "list": AtomType.LIST_BLOCK,
-            "code": AtomType.CODE_FENCE,
-            "code_fence": AtomType.CODE_FENCE,
-            "table": AtomType.TABLE,
+    if include_leaves:
+        leaf_atom_types = _atom_types_from_names(tuple(opts.leaf_types)) - {AtomType.BLANK}
+        empty_leaf_atom_types = _atom_types_from_names(tuple(opts.empty_leaf_types))
+
+        leaves_by_section = _leaves_by_section(atoms, included_nodes, leaf_atom_types)
+
+        # Leaf label/class per atom type, resolved once instead of per leaf
+        leaf_style: Dict[AtomType, Tuple[str, str]] = {
+            at: ("·", "leafEmpty") if at in empty_leaf_atom_types
+            else (_LEAF_LABELS.get(at, at.value), "leafLabeled")
+            for at in leaf_atom_types
         }
 
-        leaf_atom_types: Set[AtomType] = set()
-        for tname in opts.leaf_types:
-            at = name_to_type.get(tname.strip().lower())
-            if at is not None:
-                leaf_atom_types.add(at)
-
-        empty_leaf_atom_types: Set[AtomType] = set()
-        for tname in opts.empty_leaf_types:
-            at = name_to_type.get(tname.strip().lower())
-            if at is not None:
-                empty_leaf_atom_types.add(at)
-
-        leaves_by_section: Dict[int, List[int]] = {}
-        for a in atoms:
-            if a.atom_type == AtomType.BLANK:
-                continue
-            if a.atom_type not in leaf_atom_types:
-                continue
-            sid = _attach_section_id(a)
-            if sid is None:
-                continue
-            leaves_by_section.setdefault(sid, []).append(a.idx)
-
-        for sid, atom_indices in leaves_by_section.items():
-            atom_indices = atom_indices[: opts.max_leaves_per_section]
-
-            for ai in atom_indices:
-                a = atoms[ai]
-                leaf_id = f"A{ai}"
-
-                # Color leaves by THEIR OWN segment membership (based on atom index),
-                # so leaf colors reflect the actual split even if attached to an ancestor section.
-                sec_class = None
-                if cuts is not None:
-                    leaf_seg = _segment_of_atom_idx(ai, cuts)
-                    sec_class = f"sec{leaf_seg+1}"
-
-                if a.atom_type in empty_leaf_atom_types:
-                    lines.append(f'    {leaf_id}["·"]')
-                    lines.append(f"    S{sid} --> {leaf_id}")
-                    if sec_class is not None:
-                        lines.append(f"    class {leaf_id} leafEmpty;")
-                        lines.append(f"    class {leaf_id} {sec_class};")
-                    else:
-                        lines.append(f"    class {leaf_id} leafEmpty;")
-                else:
-                    if a.atom_type == AtomType.CODE_FENCE:
-                        lbl = "C"
-                    elif a.atom_type == AtomType.TABLE:
-                        lbl = "T"
-                    elif a.atom_type == AtomType.PARAGRAPH:
-                        lbl = "P"
-                    elif a.atom_type == AtomType.LIST_BLOCK:
-                        lbl = "L"
-                    else:
-                        lbl = a.atom_type.value
-
-                    lines.append(f'    {leaf_id}["{lbl}"]')
-                    lines.append(f"    S{sid} --> {leaf_id}")
-                    if sec_class is not None:
-                        lines.append(f"    class {leaf_id} leafLabeled;")
-                        lines.append(f"    class {leaf_id} {sec_class};")
-                    else:
-                        lines.append(f"    class {leaf_id} leafLabeled;")
-
-            total = len(leaves_by_section[sid])
-            if total > opts.max_leaves_per_section:
-                more_id = f"A{sid}_MORE"
-                lines.append(f'    {more_id}["… (+{total - opts.max_leaves_per_section})"]')
-                lines.append(f"    S{sid} --> {more_id}")
-                sec_class = None
+        for sid, full in leaves_by_section.items():
+            total = len(full)
+            atom_indices = full[: max_leaves]
+            sname = snames[sid]
+
+            # The cuts check is made once per section, not per leaf.
+            # Colored leaves take THEIR OWN segment (by atom index), so leaf colors
+            # reflect the actual split even if attached to an ancestor section.
+            if cuts is None:
+                for ai in atom_indices:
+                    lbl, leaf_class = leaf_style[atoms[ai].atom_type]
+                    w(_LEAF_FMT % (ai, lbl, sname, ai, ai, leaf_class))
+            else:
+                for ai in atom_indices:
+                    lbl, leaf_class = leaf_style[atoms[ai].atom_type]
+                    w(_LEAF_SEG_FMT_FULL % (ai, lbl, sname, ai, ai, leaf_class, ai, seg_class_names[_segment_of_atom_idx(ai, cuts)]))
+
+            if total > len(atom_indices):
+                w(_MORE_FMT % (sid, total - len(atom_indices), sname, sid, sid))
                 if cuts is not None and atom_indices:
-                    leaf_seg = _segment_of_atom_idx(atom_indices[-1], cuts)
-                    sec_class = f"sec{leaf_seg+1}"
-                if sec_class is not None:
-                    lines.append(f"    class {more_id} leafLabeled;")
-                    lines.append(f"    class {more_id} {sec_class};")
-                else:
-                    lines.append(f"    class {more_id} leafLabeled;")
+                    w(_MORE_SEG_FMT % (sid, seg_class_names[_segment_of_atom_idx(atom_indices[-1], cuts)]))
 
     # Emit section-to-section edges
-    for p, c in sorted(edges):
-        pkey = f"S{p}" if p != 0 else "ROOT"
-        ckey = f"S{c}" if c != 0 else "ROOT"
-        lines.append(f"    {pkey} --> {ckey}")
+    for p in sorted(children):
+        pkey = snames[p]
+        for c in sorted(children[p]):  # usually a handful per parent
+            w(_EDGE_FMT % (pkey, snames[c]))
 
-    lines.append("```")
-    return "\n".join(lines)
+    w("```")
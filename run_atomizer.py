@@ -1,10 +1,12 @@
 import json
+import sys
 import argparse
+from itertools import accumulate
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Tuple
 
 from atomizer import detect_mode, atomize
-from render import render_mermaid, MermaidOptions
+from render import render_mermaid_to, MermaidOptions
 from partition import build_cut_candidates, partition_into_n
 
 
@@ -27,28 +29,40 @@ def _preview(text: str, n: int = 50) -> str:
     return (s[:n] + "…") if len(s) > n else s
 
 
+# One row of the atoms table; fields match the header in print_atoms
+_ATOM_ROW = "{:>4}  {:<14} {:<11} {:<12} {:>6} {:>6} {:>3} {:>3} {:>4.2f} {:>4} {:<12}  {}".format
+
+
 def print_atoms(atoms, max_preview=50):
-    print(
+    rows: List[str] = [
         f"{'idx':>4}  {'type':<14} {'lines':<11} {'bytes':<12} "
         f"{'words':>6} {'chars':>6} {'dep':>3} {'cut':>3} {'bnd':>4} "
-        f"{'sid':>4} {'pid':<12}  preview"
-    )
-    print("-" * 140)
+        f"{'sid':>4} {'pid':<12}  preview",
+        "-" * 140,
+    ]
+    row = rows.append
+    # Atoms of one section share a path tuple, so each distinct path is joined once
+    pid_cache: Dict[Tuple[int, ...], str] = {(): "-"}
 
     for a in atoms:
-        lines = f"{a.start_line}-{a.end_line}"
-        bytes_ = f"{a.start_byte}-{a.end_byte}"
-        sid = a.section_node_id if a.section_node_id is not None else "-"
-        pid = "/".join(map(str, a.section_path_ids)) if a.section_path_ids else "-"
+        sid = str(a.section_node_id) if a.section_node_id is not None else "-"
+        pid = pid_cache.get(a.section_path_ids)
+        if pid is None:
+            pid = pid_cache[a.section_path_ids] = "/".join(map(str, a.section_path_ids))
         # path = "/".join(a.section_path) if a.section_path else "-"
         # if len(path) > 30:
         #     path = path[:27] + "…"
 
-        print(
-            f"{a.idx:>4}  {a.atom_type.value:<14} {lines:<11} {bytes_:<12} "
-            f"{a.weight_words:>6} {a.weight_chars:>6} {a.depth:>3} {int(a.can_cut_before):>3} "
-            f"{a.boundary_strength:>4.2f} {str(sid):>4} {pid:<12}  {_preview(a.text, max_preview)}"
-        )
+        # Integer fields go straight into the row template; no per-field f-string temporaries
+        row(_ATOM_ROW(
+            a.idx, a.atom_type.value,
+            "%d-%d" % (a.start_line, a.end_line), "%d-%d" % (a.start_byte, a.end_byte),
+            a.weight_words, a.weight_chars, a.depth, int(a.can_cut_before),
+            a.boundary_strength, sid, pid, _preview(a.text, max_preview),
+        ))
+
+    # Whole table in one write instead of one print() per atom
+    sys.stdout.write("\n".join(rows) + "\n")
 
     
 def _print_split(res):
@@ -118,6 +132,8 @@ def main():
         N = args.split
         allow_pseudo = not args.split_no_pseudo
         allow_hr = not args.split_no_hr
+        # Word prefix sums built once and shared by every partition attempt below
+        word_prefix = list(accumulate((a.weight_words for a in atoms), initial=0))
 
         # strict candidates first
         cands = build_cut_candidates(
@@ -130,7 +146,7 @@ def main():
 
         # attempt partition; if it fails and --split-relax, relax in stages
         try:
-            res = partition_into_n(atoms, N=N, candidates=cands)
+            res = partition_into_n(atoms, N=N, candidates=cands, word_prefix=word_prefix)
         except ValueError as e:
             if not args.split_relax:
                 raise
@@ -143,7 +159,7 @@ def main():
                 allow_paragraph_fallback=False,
             )
             try:
-                res = partition_into_n(atoms, N=N, candidates=cands2)
+                res = partition_into_n(atoms, N=N, candidates=cands2, word_prefix=word_prefix)
             except ValueError:
                 # relax 2: allow paragraph fallback
                 cands3 = build_cut_candidates(
@@ -153,7 +169,7 @@ def main():
                     allow_list_table_code=True,
                     allow_paragraph_fallback=True,
                 )
-                res = partition_into_n(atoms, N=N, candidates=cands3)
+                res = partition_into_n(atoms, N=N, candidates=cands3, word_prefix=word_prefix)
 
         _print_split(res)
 
@@ -197,8 +213,8 @@ def main():
             leaf_types=tuple(x.strip() for x in args.mermaid_leaf_types.split(",")),
             empty_leaf_types=(),
         )
-        mm = render_mermaid(atoms, section_registry, opts=opts, cuts=res.cuts if res else None)
-        Path(args.mermaid_out).write_text(mm, encoding="utf-8")
+        with open(args.mermaid_out, "w", encoding="utf-8") as f:
+            render_mermaid_to(f, atoms, section_registry, opts=opts, cuts=res.cuts if res else None)
         print(f"Wrote Mermaid diagram to: {args.mermaid_out}")
 
 